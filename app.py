@@ -8,10 +8,17 @@ Supports multiple bank/card accounts per user.
 import os
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
+import random
+import time
+import uuid
+import orjson
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, render_template, redirect
-from flask_cors import CORS
+from flask import Flask, Response, request, jsonify, render_template
+from flask.json.provider import DefaultJSONProvider
 from config import Config
 from encryption import encrypt_credentials, decrypt_credentials
 from firebase_client import (
@@ -20,9 +27,12 @@ from firebase_client import (
     get_user_credentials,
     get_user_connected_accounts,
     get_all_enabled_accounts,
-    update_last_scraped,
     delete_user_credentials,
-    save_scraped_expenses,
+    update_status_after_delete,
+    save_scrape_result,
+    mark_accounts_pending,
+    acquire_scrape_job_lock,
+    release_scrape_job_lock,
     update_scraper_status
 )
 
@@ -33,29 +43,104 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Skip per-request access logs from the development server outside debug mode
+if os.environ.get('FLASK_DEBUG', 'false').lower() != 'true':
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for faster request/response (de)serialization."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
 app.config.from_object(Config)
-CORS(app)
+app.json = OrjsonProvider(app)
+
+# Fixed CORS headers - set directly instead of going through flask-cors' per-request matching
+_CORS_HEADERS = [
+    ('Access-Control-Allow-Origin', Config.CORS_ALLOWED_ORIGIN),
+    ('Access-Control-Allow-Headers', 'Authorization, Content-Type'),
+    ('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS'),
+]
+
+
+@app.before_request
+def handle_cors_preflight():
+    """Answer CORS preflight requests without hitting the view (headers added below)."""
+    if request.method == 'OPTIONS':
+        return '', 204
+
+
+@app.after_request
+def add_cors_headers(response):
+    """Attach CORS headers to every response."""
+    response.headers.update(_CORS_HEADERS)
+    return response
+
+
+# Shared HTTP session for calls to the scraper service - keeps connections
+# alive across scrapes instead of doing a fresh TCP+TLS handshake every time
+# Transient scraper errors (429/502/503, connection failures) are retried with
+# exponential backoff + jitter before an account is marked as failed.
+# Read timeouts (read=False) and 504s are NOT retried: the scraper may still be
+# logging in to the bank, and a second login with the same credentials risks a lockout
+_retry = Retry(
+    total=3,
+    read=False,
+    backoff_factor=0.5,
+    backoff_jitter=0.3,
+    status_forcelist=(429, 502, 503),
+    allowed_methods=frozenset(['POST']),
+    raise_on_status=False
+)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_retry)
+_session = requests.Session()
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+# Extra attempts when connecting to the scraper service times out
+SCRAPE_TIMEOUT_RETRIES = 1
+
+# Executor for initial scrapes triggered by credential submission, so the
+# request returns immediately instead of waiting on the scraper service
+_scrape_pool = ThreadPoolExecutor(max_workers=32)
+
+# Single-slot executor for the scheduled scrape job - at most one sweep runs
+# per process, duplicate scheduler calls are rejected while it is in flight.
+# Across workers/instances the sweep is guarded by a lease in Firebase (scrape_job_lock)
+_job_executor = ThreadPoolExecutor(max_workers=1)
+_job_inflight = threading.Lock()
+
+# In-flight scrapes keyed by (user_id, company_id) -> (credentials, start_date, Future), so a
+# duplicate request for the same account and range joins the running scrape instead of starting another
+_inflight_scrapes = {}
+_inflight_scrapes_lock = threading.Lock()
 
 # Bank/card credential field configurations
 CREDENTIAL_FIELDS = {
-    'leumi': ['username', 'password'],
-    'mizrahi': ['username', 'password'],
-    'otsarHahayal': ['username', 'password'],
-    'max': ['username', 'password'],
-    'visaCal': ['username', 'password'],
-    'union': ['username', 'password'],
-    'beinleumi': ['username', 'password'],
-    'massad': ['username', 'password'],
-    'pagi': ['username', 'password'],
-    'hapoalim': ['userCode', 'password'],
-    'discount': ['id', 'password', 'num'],
-    'mercantile': ['id', 'password', 'num'],
-    'isracard': ['id', 'password', 'card6Digits'],
-    'amex': ['id', 'password', 'card6Digits'],
-    'yahav': ['username', 'password'],  # TODO: add nationalID
-    'beyahadBishvilha': ['id', 'password'],
-    'behatsdaa': ['id', 'password'],
+    'leumi': ('username', 'password'),
+    'mizrahi': ('username', 'password'),
+    'otsarHahayal': ('username', 'password'),
+    'max': ('username', 'password'),
+    'visaCal': ('username', 'password'),
+    'union': ('username', 'password'),
+    'beinleumi': ('username', 'password'),
+    'massad': ('username', 'password'),
+    'pagi': ('username', 'password'),
+    'hapoalim': ('userCode', 'password'),
+    'discount': ('id', 'password', 'num'),
+    'mercantile': ('id', 'password', 'num'),
+    'isracard': ('id', 'password', 'card6Digits'),
+    'amex': ('id', 'password', 'card6Digits'),
+    'yahav': ('username', 'password'),  # TODO: add nationalID
+    'beyahadBishvilha': ('id', 'password'),
+    'behatsdaa': ('id', 'password'),
 }
 
 COMPANY_DISPLAY_NAMES = {
@@ -113,7 +198,8 @@ def index():
 def submit_credentials():
     """
     Receive and store encrypted credentials, then trigger initial scrape.
-    Supports multiple accounts per user.
+    The scrape runs in the background; the response is returned with 202
+    as soon as credentials are saved. Supports multiple accounts per user.
     
     Expected JSON body:
     {
@@ -155,14 +241,14 @@ def submit_credentials():
             return jsonify({'error': str(e)}), 401
         
         # Validate company_id
-        if company_id not in CREDENTIAL_FIELDS:
+        required_fields = CREDENTIAL_FIELDS.get(company_id)
+        if required_fields is None:
             return jsonify({'error': f'Invalid company: {company_id}'}), 400
         
         # Validate required credential fields for this company
-        required_fields = CREDENTIAL_FIELDS[company_id]
-        for field in required_fields:
-            if not credentials.get(field):
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        missing = next((field for field in required_fields if not credentials.get(field)), None)
+        if missing:
+            return jsonify({'error': f'Missing required field: {missing}'}), 400
         
         # Encrypt credentials
         encrypted = encrypt_credentials(credentials)
@@ -173,25 +259,17 @@ def submit_credentials():
         # Update status to pending
         update_scraper_status(user_id, 'pending', company_id=company_id)
         
-        # Trigger immediate scrape
-        scrape_result = trigger_scrape(user_id, company_id, credentials, start_date)
+        # Trigger initial scrape in the background - progress is reported via /status
+        _scrape_pool.submit(trigger_scrape, user_id, company_id, credentials, start_date)
         
-        if scrape_result.get('success'):
-            return jsonify({
-                'success': True,
-                'message': 'Credentials saved and initial scrape completed successfully',
-                'newTransactions': scrape_result.get('new_count', 0)
-            })
-        else:
-            # Credentials saved but scrape failed
-            return jsonify({
-                'success': True,
-                'message': 'Credentials saved. Scraping encountered an issue but will retry.',
-                'scrapeError': scrape_result.get('error')
-            })
+        return jsonify({
+            'success': True,
+            'status': 'pending',
+            'message': 'Credentials saved. Initial scrape started.'
+        }), 202
     
     except Exception as e:
-        logger.error(f"Error in submit_credentials: {e}")
+        logger.error("Error in submit_credentials: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 
@@ -200,6 +278,7 @@ def scrape_job():
     """
     Internal endpoint called by scheduler to run daily scrape jobs.
     Returns immediately and runs scraping in background thread.
+    Returns 409 if a scrape job is already running.
     Requires scheduler secret for authentication.
     """
     try:
@@ -210,78 +289,145 @@ def scrape_job():
         if auth_header != expected:
             return jsonify({'error': 'Unauthorized'}), 401
         
-        # Get count of accounts to process (for the response)
-        enabled_accounts = get_all_enabled_accounts()
-        account_count = len(enabled_accounts)
+        # Reject overlapping runs (e.g. scheduler retries) instead of starting a second sweep.
+        # The local lock is checked first, then the lease shared with other workers
+        if not _job_inflight.acquire(blocking=False):
+            return _job_already_running()
+        
+        lock_owner = uuid.uuid4().hex
+        try:
+            if not acquire_scrape_job_lock(lock_owner, Config.SCRAPE_JOB_LOCK_TTL):
+                _job_inflight.release()
+                return _job_already_running()
+        except Exception:
+            _job_inflight.release()
+            raise
         
-        # Start background thread for scraping
-        thread = threading.Thread(target=run_scrape_job_background)
-        thread.daemon = True
-        thread.start()
+        try:
+            # Get count of accounts to process (for the response)
+            enabled_accounts = get_all_enabled_accounts()
+            account_count = len(enabled_accounts)
+            
+            # Run scraping in the background job executor
+            _job_executor.submit(run_scrape_job_background, enabled_accounts, lock_owner)
+        except Exception:
+            _release_job_locks(lock_owner)
+            raise
         
         # Return immediately
-        logger.info(f"Scrape job started in background for {account_count} accounts")
+        logger.info("Scrape job started in background for %s accounts", account_count)
         return jsonify({
             'status': 'started',
             'message': f'Scrape job started in background for {account_count} accounts'
         })
     
     except Exception as e:
-        logger.error(f"Error starting scrape_job: {e}")
+        logger.error("Error starting scrape_job: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 
-def run_scrape_job_background():
-    """Run the actual scraping in background thread."""
+def _job_already_running():
+    """409 response for a scrape job request while another sweep is running."""
+    return jsonify({
+        'status': 'already_running',
+        'message': 'A scrape job is already running'
+    }), 409
+
+
+def _release_job_locks(lock_owner: str):
+    """Release the shared scrape job lease and the local in-flight lock."""
+    try:
+        release_scrape_job_lock(lock_owner)
+    except Exception as e:
+        # The lease expires on its own after SCRAPE_JOB_LOCK_TTL
+        logger.error("Failed to release scrape job lock: %s", e)
+    finally:
+        _job_inflight.release()
+
+
+def run_scrape_job_background(enabled_accounts: list, lock_owner: str):
+    """
+    Run the actual scraping in background thread.
+    
+    Args:
+        enabled_accounts: (user_id, company_id, account_data) tuples as returned
+                          by get_all_enabled_accounts()
+        lock_owner: ID of the scrape job lease held by this run, released when done
+    """
     try:
         logger.info("Background scrape job started")
         
-        # Get all accounts with scraping enabled
-        enabled_accounts = get_all_enabled_accounts()
-        
         results = {
             'processed': 0,
             'success': 0,
             'failed': 0
         }
+        results_lock = threading.Lock()
+        
+        # Mark every account as pending in one batched write
+        mark_accounts_pending(enabled_accounts)
+        
+        # Scrape the last 30 days (relative to job start) for every account
+        start_date = (datetime.utcnow().date() - timedelta(days=30)).isoformat()
+        
+        # Group accounts per user - a user's expenses/status are merged with
+        # read-modify-write, so their accounts must not be scraped concurrently
+        accounts_by_user = {}
+        for account in enabled_accounts:
+            accounts_by_user.setdefault(account[0], []).append(account)
+        
+        def process_user_accounts(user_accounts):
+            for account in user_accounts:
+                success = _process_account(*account, start_date)
+                with results_lock:
+                    results['processed'] += 1
+                    if success:
+                        results['success'] += 1
+                    else:
+                        results['failed'] += 1
+        
+        # Scrape users concurrently - each scrape is I/O bound (scraper service + Firebase)
+        with ThreadPoolExecutor(max_workers=Config.SCRAPE_CONCURRENCY) as executor:
+            list(executor.map(process_user_accounts, accounts_by_user.values()))
+        
+        logger.info("Background scrape job completed: %s/%s successful", results['success'], results['processed'])
+    
+    except Exception as e:
+        logger.error("Error in background scrape job: %s", e)
+    
+    finally:
+        _release_job_locks(lock_owner)
+
+
+def _process_account(user_id: str, company_id: str, account_data: dict, start_date: str) -> bool:
+    """
+    Scrape a single account as part of the background scrape job.
+    
+    Returns:
+        True if the scrape succeeded, False otherwise
+    """
+    try:
+        # Decrypt credentials
+        encrypted = account_data.get('credentials')
         
-        for user_id, company_id, account_data in enabled_accounts:
-            results['processed'] += 1
-            
-            try:
-                # Decrypt credentials
-                encrypted = account_data.get('credentials')
-                
-                if not encrypted:
-                    results['failed'] += 1
-                    logger.error(f'{user_id}/{company_id}: Missing credentials')
-                    continue
-                
-                credentials = decrypt_credentials(encrypted)
-                
-                # Update status to pending
-                update_scraper_status(user_id, 'pending', company_id=company_id)
-                
-                # Trigger scrape (use last 30 days as default)
-                start_date = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
-                
-                scrape_result = trigger_scrape(user_id, company_id, credentials, start_date)
-                
-                if scrape_result.get('success'):
-                    results['success'] += 1
-                else:
-                    results['failed'] += 1
-                    logger.error(f'{user_id}/{company_id}: {scrape_result.get("error")}')
-            
-            except Exception as e:
-                results['failed'] += 1
-                logger.error(f'{user_id}/{company_id}: {str(e)}')
-                update_scraper_status(user_id, 'error', str(e), company_id=company_id)
+        if not encrypted:
+            logger.error("%s/%s: Missing credentials", user_id, company_id)
+            return False
+        
+        credentials = decrypt_credentials(encrypted)
         
-        logger.info(f"Background scrape job completed: {results['success']}/{results['processed']} successful")
+        scrape_result = trigger_scrape(user_id, company_id, credentials, start_date)
+        
+        if scrape_result.get('success'):
+            return True
+        
+        logger.error("%s/%s: %s", user_id, company_id, scrape_result.get('error'))
+        return False
     
     except Exception as e:
-        logger.error(f"Error in background scrape job: {e}")
+        logger.error("%s/%s: %s", user_id, company_id, e)
+        update_scraper_status(user_id, 'error', str(e), company_id=company_id)
+        return False
 
 
 @app.route('/status/<user_id>', methods=['GET'])
@@ -330,7 +476,7 @@ def get_status(user_id):
         })
     
     except Exception as e:
-        logger.error(f"Error in get_status: {e}")
+        logger.error("Error in get_status: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 
@@ -361,39 +507,25 @@ def delete_credentials():
         delete_user_credentials(user_id, company_id)
         
         # Update status
-        from firebase_client import db, init_firebase
-        init_firebase()
-        
-        remaining_accounts = get_user_connected_accounts(user_id)
+        remaining_accounts = update_status_after_delete(user_id)
         
-        status_ref = db.reference(f'scraper_status/{user_id}')
         if remaining_accounts:
-            # Still have some accounts, update status
-            status_ref.update({
-                'connected_accounts': remaining_accounts
-            })
             message = f'Credentials for {company_id} deleted successfully'
         else:
-            # No more accounts
-            status_ref.set({
-                'status': 'deleted',
-                'has_credentials': False,
-                'last_run': None,
-                'error_message': None,
-                'connected_accounts': []
-            })
             message = 'All credentials deleted successfully'
         
         return jsonify({'success': True, 'message': message})
     
     except Exception as e:
-        logger.error(f"Error in delete_credentials: {e}")
+        logger.error("Error in delete_credentials: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 
 def trigger_scrape(user_id: str, company_id: str, credentials: dict, start_date: str) -> dict:
     """
     Trigger a scrape request to the bank-scraper-service.
+    If a scrape with the same credentials and start date is already running for
+    this account, waits for it and returns its result instead of starting a second one.
     
     Args:
         user_id: Firebase user ID
@@ -402,37 +534,78 @@ def trigger_scrape(user_id: str, company_id: str, credentials: dict, start_date:
         start_date: Start date for scraping (YYYY-MM-DD)
     
     Returns:
-        Dict with 'success' boolean, optional 'error' message, and 'new_count' for new transactions
+        Dict with 'success' boolean, optional 'error' message, and 'new_count' for transactions written
     """
+    key = (user_id, company_id)
+    with _inflight_scrapes_lock:
+        inflight = _inflight_scrapes.get(key)
+        if inflight and inflight[0] == credentials and inflight[1] == start_date:
+            future = inflight[2]
+            is_owner = False
+        else:
+            future = Future()
+            _inflight_scrapes[key] = (credentials, start_date, future)
+            is_owner = True
+    
+    if not is_owner:
+        logger.info("Scrape already in progress for %s/%s, joining it", user_id, company_id)
+        return future.result()
+    
+    try:
+        result = _run_scrape(user_id, company_id, credentials, start_date)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_scrapes_lock:
+            if _inflight_scrapes.get(key, (None, None, None))[2] is future:
+                del _inflight_scrapes[key]
+
+
+def _run_scrape(user_id: str, company_id: str, credentials: dict, start_date: str) -> dict:
+    """Call the bank-scraper-service and persist the result (see trigger_scrape)."""
     try:
         # Prepare request to scraper service
         scraper_url = f"{Config.SCRAPER_SERVICE_URL}/scrape"
         
-        payload = {
+        payload = orjson.dumps({
             'companyId': company_id,
             'credentials': credentials,
             'startDate': start_date
-        }
+        })
         
-        # Call scraper service with generous timeout
-        response = requests.post(
-            scraper_url,
-            json=payload,
-            timeout=300  # 5 minutes
-        )
+        # Call scraper service with generous timeout. Only a connect timeout is retried
+        # here - the request never reached the scraper. A read timeout means the scrape
+        # may still be running, so it is reported instead of logging in to the bank again
+        for attempt in range(SCRAPE_TIMEOUT_RETRIES + 1):
+            try:
+                response = _session.post(
+                    scraper_url,
+                    data=payload,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=300  # 5 minutes
+                )
+                break
+            except requests.ConnectTimeout:
+                if attempt == SCRAPE_TIMEOUT_RETRIES:
+                    raise
+                logger.warning("Connecting to scraper timed out for %s/%s, retrying", user_id, company_id)
+                time.sleep(2 ** attempt + random.uniform(0, 1))
         
         if response.status_code != 200:
             error_msg = f"Scraper service returned {response.status_code}"
             update_scraper_status(user_id, 'error', error_msg, company_id=company_id)
             return {'success': False, 'error': error_msg}
         
-        result = response.json()
+        # Scrape results can carry many transactions - decode with orjson
+        result = orjson.loads(response.content)
         
         if result.get('success'):
-            # Save scraped expenses to Firebase (merges with existing)
-            new_count = save_scraped_expenses(user_id, company_id, result)
-            update_last_scraped(user_id, company_id)
-            update_scraper_status(user_id, 'success', company_id=company_id)
+            # Save scraped expenses, last_scraped and status (merges with existing)
+            new_count = save_scrape_result(user_id, company_id, result)
             return {'success': True, 'new_count': new_count}
         else:
             error_msg = result.get('errorMessage', 'Unknown scraping error')
@@ -446,15 +619,19 @@ def trigger_scrape(user_id: str, company_id: str, credentials: dict, start_date:
     
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Error triggering scrape for {user_id}/{company_id}: {error_msg}")
+        logger.error("Error triggering scrape for %s/%s: %s", user_id, company_id, error_msg)
         update_scraper_status(user_id, 'error', error_msg, company_id=company_id)
         return {'success': False, 'error': error_msg}
 
 
+# Pre-serialized health check body - probed frequently by the platform
+_HEALTH_BODY = orjson.dumps({'status': 'healthy'})
+
+
 @app.route('/health')
 def health():
     """Health check endpoint."""
-    return jsonify({'status': 'healthy'})
+    return Response(_HEALTH_BODY, mimetype='application/json')
 
 
 
@@ -501,4 +678,7 @@ def get_api_keys():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG', 'false').lower() == 'true')
+    debug = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
+    if not debug:
+        logger.warning("Running the Flask development server - use 'gunicorn -c gunicorn_conf.py app:app' in production")
+    app.run(host='0.0.0.0', port=port, debug=debug)
@@ -20,4 +20,14 @@ class Config:
     
     # Scheduler secret for authenticating scheduled job requests
     SCHEDULER_SECRET = os.environ.get('SCHEDULER_SECRET', 'scheduler-secret-change-in-production')
+    
+    # Origin allowed to call the API from a browser (CORS)
+    CORS_ALLOWED_ORIGIN = os.environ.get('CORS_ALLOWED_ORIGIN', '*')
+    
+    # Max number of accounts scraped concurrently by the background scrape job
+    SCRAPE_CONCURRENCY = int(os.environ.get('SCRAPE_CONCURRENCY', '20'))
+    
+    # Seconds the scrape job lease is held before another instance may start a new sweep.
+    # Must be longer than a full sweep - the lease is released early when the job finishes
+    SCRAPE_JOB_LOCK_TTL = int(os.environ.get('SCRAPE_JOB_LOCK_TTL', '10800'))
 
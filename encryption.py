@@ -4,13 +4,15 @@ Uses AES-256-GCM for authenticated encryption.
 """
 import os
 import base64
-import json
+import orjson
+import functools
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from config import Config
 
 
+@functools.lru_cache(maxsize=1)
 def get_encryption_key():
-    """Get or generate encryption key."""
+    """Get or generate encryption key (decoded once and cached for the process)."""
     key = Config.ENCRYPTION_KEY
     if not key:
         raise ValueError("ENCRYPTION_KEY environment variable must be set in production")
@@ -22,6 +24,12 @@ def get_encryption_key():
         return key.encode()[:32].ljust(32, b'\0')
 
 
+@functools.lru_cache(maxsize=1)
+def _get_aesgcm() -> AESGCM:
+    """Get the shared AESGCM cipher (created once and reused for every call)."""
+    return AESGCM(get_encryption_key())
+
+
 def encrypt_credentials(credentials: dict) -> dict:
     """
     Encrypt credentials dictionary using AES-256-GCM.
@@ -32,14 +40,13 @@ def encrypt_credentials(credentials: dict) -> dict:
     Returns:
         Dictionary with 'encrypted_data' and 'nonce' (both base64 encoded)
     """
-    key = get_encryption_key()
-    aesgcm = AESGCM(key)
+    aesgcm = _get_aesgcm()
     
     # Generate a random 96-bit nonce
     nonce = os.urandom(12)
     
     # Convert credentials to JSON bytes
-    plaintext = json.dumps(credentials).encode('utf-8')
+    plaintext = orjson.dumps(credentials)
     
     # Encrypt
     ciphertext = aesgcm.encrypt(nonce, plaintext, None)
@@ -60,8 +67,7 @@ def decrypt_credentials(encrypted: dict) -> dict:
     Returns:
         Original credentials dictionary
     """
-    key = get_encryption_key()
-    aesgcm = AESGCM(key)
+    aesgcm = _get_aesgcm()
     
     # Decode from base64
     ciphertext = base64.b64decode(encrypted['encrypted_data'])
@@ -70,7 +76,7 @@ def decrypt_credentials(encrypted: dict) -> dict:
     # Decrypt
     plaintext = aesgcm.decrypt(nonce, ciphertext, None)
     
-    return json.loads(plaintext.decode('utf-8'))
+    return orjson.loads(plaintext)
 
 
 def generate_encryption_key():
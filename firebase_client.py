@@ -9,39 +9,50 @@ from datetime import datetime
 import logging
 import hashlib
 import os
-import json
-import base64
+import orjson
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
-# Initialize Firebase Admin SDK
-_initialized = False
+# Fields stored directly under user_credentials/{user_id} by the old single-account format
+_LEGACY_ACCOUNT_FIELDS = frozenset({'credentials', 'scraping_enabled', 'created_at', 'last_scraped'})
+
+# Short-lived cache of verified ID tokens: sha256(token) -> (expires_at, decoded_token)
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX_SIZE = 10000
+_token_cache = {}
+_token_cache_lock = threading.Lock()
 
 def init_firebase():
     """Initialize Firebase Admin SDK."""
-    global _initialized
-    if _initialized:
-        return
-    
     try:
         creds_json = os.environ.get('FIREBASE_CREDENTIALS_JSON')
         if creds_json:
-            creds_dict = json.loads(creds_json)
+            creds_dict = orjson.loads(creds_json)
             cred = credentials.Certificate(creds_dict)
+        else:
+            cred = credentials.Certificate(Config.FIREBASE_CREDENTIALS_PATH)
         
         firebase_admin.initialize_app(cred, {
             'databaseURL': Config.FIREBASE_DATABASE_URL
         })
-        _initialized = True
         logger.info("Firebase initialized successfully")
     except Exception as e:
-        logger.error(f"Failed to initialize Firebase: {e}")
+        logger.error("Failed to initialize Firebase: %s", e)
         raise
 
 
+# Initialize once at import. A failure is raised so the worker fails to boot
+# instead of serving every request with a missing default app
+init_firebase()
+
+
 def verify_firebase_token(id_token: str) -> dict:
     """
     Verify a Firebase ID token and return the decoded token.
+    Verified tokens are cached for up to TOKEN_CACHE_TTL seconds (never past
+    their own expiry) so repeated calls, e.g. /status polling, skip verification.
     
     Args:
         id_token: Firebase ID token from the client
@@ -52,13 +63,33 @@ def verify_firebase_token(id_token: str) -> dict:
     Raises:
         ValueError: If token is invalid
     """
-    init_firebase()
+    if not isinstance(id_token, str):
+        raise ValueError("Invalid Firebase token: token must be a string")
+    
+    cache_key = hashlib.sha256(id_token.encode()).digest()
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached and cached[0] > now:
+        return cached[1]
+    
     try:
         decoded_token = auth.verify_id_token(id_token)
-        return decoded_token
     except Exception as e:
-        logger.error(f"Token verification failed: {e}")
+        logger.error("Token verification failed: %s", e)
         raise ValueError(f"Invalid Firebase token: {e}")
+    
+    # Never cache past the token's own expiry
+    expires_at = min(now + TOKEN_CACHE_TTL, decoded_token.get('exp', now))
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+            for key in [k for k, v in _token_cache.items() if v[0] <= now]:
+                del _token_cache[key]
+            if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+                _token_cache.clear()
+        _token_cache[cache_key] = (expires_at, decoded_token)
+    
+    return decoded_token
 
 
 def save_user_credentials(user_id: str, company_id: str, encrypted_credentials: dict):
@@ -71,7 +102,6 @@ def save_user_credentials(user_id: str, company_id: str, encrypted_credentials:
         company_id: Bank/card company identifier
         encrypted_credentials: Dictionary with encrypted_data and nonce
     """
-    init_firebase()
     # Store credentials under user_id/company_id to support multiple accounts
     ref = db.reference(f'user_credentials/{user_id}/{company_id}')
     ref.set({
@@ -80,7 +110,8 @@ def save_user_credentials(user_id: str, company_id: str, encrypted_credentials:
         'created_at': datetime.utcnow().isoformat(),
         'last_scraped': None
     })
-    logger.info(f"Saved credentials for user {user_id}, company {company_id}")
+    _update_connected_accounts(user_id)
+    logger.info("Saved credentials for user %s, company %s", user_id, company_id)
 
 
 def get_user_credentials(user_id: str, company_id: str = None) -> dict:
@@ -95,7 +126,6 @@ def get_user_credentials(user_id: str, company_id: str = None) -> dict:
         User credentials data or None if not found
         If company_id is None, returns all accounts for the user
     """
-    init_firebase()
     if company_id:
         ref = db.reference(f'user_credentials/{user_id}/{company_id}')
         data = ref.get()
@@ -117,13 +147,31 @@ def get_user_connected_accounts(user_id: str) -> list:
     Returns:
         List of company IDs that the user has connected
     """
-    init_firebase()
+    # Shallow read - only child keys, not every account's encrypted credentials.
+    # Object children come back as True, primitive children as their value.
     ref = db.reference(f'user_credentials/{user_id}')
-    data = ref.get() or {}
+    data = ref.get(shallow=True) or {}
     
-    # Only include entries that are proper account objects (dict with 'credentials')
-    return [key for key, value in data.items() 
-            if isinstance(value, dict) and 'credentials' in value]
+    # Only include account objects - skip fields of the legacy single-account format
+    return [key for key, value in data.items()
+            if value is True and key not in _LEGACY_ACCOUNT_FIELDS]
+
+
+def _update_connected_accounts(user_id: str) -> list:
+    """
+    Refresh the connected_accounts summary stored under scraper_status and
+    scraped_expenses. Called only when a user's accounts change, so status and
+    expense writes don't need to re-read user_credentials.
+    
+    Returns:
+        List of company IDs that the user has connected
+    """
+    connected_accounts = get_user_connected_accounts(user_id)
+    db.reference().update({
+        f'scraper_status/{user_id}/connected_accounts': connected_accounts,
+        f'scraped_expenses/{user_id}/connected_accounts': connected_accounts
+    })
+    return connected_accounts
 
 
 def get_all_enabled_accounts() -> list:
@@ -133,7 +181,6 @@ def get_all_enabled_accounts() -> list:
     Returns:
         List of (user_id, company_id, account_data) tuples
     """
-    init_firebase()
     ref = db.reference('user_credentials')
     all_users = ref.get() or {}
     
@@ -149,11 +196,20 @@ def get_all_enabled_accounts() -> list:
     return enabled_accounts
 
 
-def update_last_scraped(user_id: str, company_id: str):
-    """Update the last_scraped timestamp for a specific account."""
-    init_firebase()
-    ref = db.reference(f'user_credentials/{user_id}/{company_id}/last_scraped')
-    ref.set(datetime.utcnow().isoformat())
+def update_last_scraped(user_id: str, company_id: str, now: str = None):
+    """
+    Update the last_scraped timestamp for a specific account.
+    Skipped for accounts without credentials, so a scrape finishing after the
+    account was deleted doesn't recreate it as an empty node.
+    """
+    ref = db.reference(f'user_credentials/{user_id}/{company_id}')
+    
+    # Shallow read - only the child keys, not the encrypted credentials
+    account_keys = ref.get(shallow=True)
+    if not isinstance(account_keys, dict) or 'credentials' not in account_keys:
+        return
+    
+    ref.update({'last_scraped': now or datetime.utcnow().isoformat()})
 
 
 def delete_user_credentials(user_id: str, company_id: str = None):
@@ -165,15 +221,39 @@ def delete_user_credentials(user_id: str, company_id: str = None):
         company_id: Optional - if provided, deletes only that company's credentials
                    If None, deletes ALL credentials for the user
     """
-    init_firebase()
     if company_id:
         ref = db.reference(f'user_credentials/{user_id}/{company_id}')
         ref.delete()
-        logger.info(f"Deleted credentials for user {user_id}, company {company_id}")
+        logger.info("Deleted credentials for user %s, company %s", user_id, company_id)
     else:
         ref = db.reference(f'user_credentials/{user_id}')
         ref.delete()
-        logger.info(f"Deleted all credentials for user {user_id}")
+        logger.info("Deleted all credentials for user %s", user_id)
+
+
+def update_status_after_delete(user_id: str) -> list:
+    """
+    Refresh a user's scraper status after credentials were deleted.
+    
+    Args:
+        user_id: Firebase user ID
+        
+    Returns:
+        List of company IDs the user still has connected
+    """
+    remaining_accounts = _update_connected_accounts(user_id)
+    
+    if not remaining_accounts:
+        # No more accounts
+        db.reference(f'scraper_status/{user_id}').set({
+            'status': 'deleted',
+            'has_credentials': False,
+            'last_run': None,
+            'error_message': None,
+            'connected_accounts': []
+        })
+    
+    return remaining_accounts
 
 
 def generate_transaction_id(txn: dict) -> str:
@@ -186,38 +266,31 @@ def generate_transaction_id(txn: dict) -> str:
     Returns:
         Unique hash string for the transaction
     """
-    # Create a unique key from transaction details
-    key_parts = [
-        str(txn.get('date', '')),
-        str(txn.get('description', '')),
-        str(txn.get('chargedAmount', txn.get('originalAmount', ''))),
-        str(txn.get('identifier', ''))  # Some scrapers provide unique identifiers
-    ]
-    key_string = '|'.join(key_parts)
-    return hashlib.md5(key_string.encode()).hexdigest()
+    # Create a unique key from transaction details (identifier is provided by some scrapers)
+    get = txn.get
+    key_string = (
+        f"{get('date', '')}|{get('description', '')}|"
+        f"{get('chargedAmount', get('originalAmount', ''))}|{get('identifier', '')}"
+    )
+    # MD5 is only a dedup fingerprint here, not a security primitive. Changing the
+    # algorithm would change the IDs of already-stored transactions and duplicate them.
+    return hashlib.md5(key_string.encode(), usedforsecurity=False).hexdigest()
 
 
-def save_scraped_expenses(user_id: str, company_id: str, expenses_data: dict):
+def _collect_transactions(company_id: str, expenses_data: dict, path_prefix: str) -> dict:
     """
-    Save scraped expenses to Firebase for the app to read.
-    Merges new transactions with existing ones to avoid duplicates.
+    Collect scraped transactions as update paths keyed by their deterministic
+    transaction ID, ready to be merged into a multi-location update.
     
     Args:
-        user_id: Firebase user ID
         company_id: Bank/card company identifier
         expenses_data: Scraped expenses data from the scraper service
+        path_prefix: Path under which transactions are stored (e.g. 'transactions/')
+        
+    Returns:
+        Dictionary mapping f'{path_prefix}{txn_id}' to the transaction
     """
-    init_firebase()
-    
-    # Get existing expenses for this user
-    ref = db.reference(f'scraped_expenses/{user_id}')
-    existing_data = ref.get() or {}
-    
-    # Get existing transactions (keyed by transaction ID for dedup)
-    existing_txns = existing_data.get('transactions', {})
-    
-    # Process new transactions from all accounts in the scraped data
-    new_txn_count = 0
+    txn_updates = {}
     accounts = expenses_data.get('accounts', [])
     
     for account in accounts:
@@ -230,67 +303,200 @@ def save_scraped_expenses(user_id: str, company_id: str, expenses_data: dict):
             txn['source_account'] = account_number
             
             # Generate unique ID for deduplication
-            txn_id = generate_transaction_id(txn)
-            
-            # Only add if not already exists
-            if txn_id not in existing_txns:
-                existing_txns[txn_id] = txn
-                new_txn_count += 1
+            txn_updates[path_prefix + generate_transaction_id(txn)] = txn
     
-    # Update the database with merged transactions
-    ref.set({
-        'last_updated': datetime.utcnow().isoformat(),
-        'transactions': existing_txns,
-        # Keep a summary of connected accounts
-        'connected_accounts': get_user_connected_accounts(user_id)
-    })
+    return txn_updates
+
+
+def save_scraped_expenses(user_id: str, company_id: str, expenses_data: dict):
+    """
+    Save scraped expenses to Firebase for the app to read.
+    Transactions are upserted under their hash-based ID, so re-scraped
+    transactions land on the same key instead of creating duplicates -
+    no need to read existing transactions first.
+    
+    Args:
+        user_id: Firebase user ID
+        company_id: Bank/card company identifier
+        expenses_data: Scraped expenses data from the scraper service
+        
+    Returns:
+        Number of transactions written
+    """
+    ref = db.reference(f'scraped_expenses/{user_id}')
+    
+    # Write transactions as child paths instead of re-uploading the whole map
+    updates = _collect_transactions(company_id, expenses_data, 'transactions/')
+    txn_count = len(updates)
+    updates['last_updated'] = datetime.utcnow().isoformat()
+    ref.update(updates)
     
-    logger.info(f"Saved {new_txn_count} new transactions for user {user_id} from {company_id}")
-    return new_txn_count
+    logger.info("Upserted %s transactions for user %s from %s", txn_count, user_id, company_id)
+    return txn_count
 
 
-def update_scraper_status(user_id: str, status: str, error_message: str = None, company_id: str = None):
+def save_scrape_result(user_id: str, company_id: str, expenses_data: dict) -> int:
     """
-    Update the scraper status for a user.
+    Persist a successful scrape.
+    Equivalent to save_scraped_expenses + update_last_scraped +
+    update_scraper_status(..., 'success'): transactions and the account's status
+    go in one multi-location update, then the overall status is recomputed in a
+    transaction so concurrent status writes are retried instead of overwritten.
+    last_scraped is set separately, only if the account still exists.
     
     Args:
         user_id: Firebase user ID
-        status: 'success', 'error', or 'pending'
-        error_message: Optional error message if status is 'error'
-        company_id: Optional company ID for account-specific status
+        company_id: Bank/card company identifier
+        expenses_data: Scraped expenses data from the scraper service
+        
+    Returns:
+        Number of transactions written
     """
-    init_firebase()
+    now = datetime.utcnow().isoformat()
     
-    # Update overall user status
-    ref = db.reference(f'scraper_status/{user_id}')
-    current_status = ref.get() or {}
+    updates = _collect_transactions(company_id, expenses_data, f'scraped_expenses/{user_id}/transactions/')
+    txn_count = len(updates)
     
+    # Status is written as child paths only - rewriting the whole node would undo
+    # a concurrent pending entry or connected_accounts refresh for another account
+    updates.update({
+        f'scraped_expenses/{user_id}/last_updated': now,
+        f'scraper_status/{user_id}/accounts/{company_id}': {
+            'status': 'success',
+            'last_run': now,
+            'error_message': None
+        },
+        f'scraper_status/{user_id}/last_run': now,
+        f'scraper_status/{user_id}/has_credentials': True
+    })
+    db.reference().update(updates)
+    update_last_scraped(user_id, company_id, now)
+    
+    # The overall status depends on every account's status - recompute it in a transaction
+    db.reference(f'scraper_status/{user_id}').transaction(_refresh_overall_status)
+    
+    logger.info("Upserted %s transactions for user %s from %s", txn_count, user_id, company_id)
+    return txn_count
+
+
+def mark_accounts_pending(accounts: list):
+    """
+    Mark many accounts as pending in a single multi-location update.
+    
+    Args:
+        accounts: List of (user_id, company_id, ...) tuples
+    """
+    if not accounts:
+        return
+    now = datetime.utcnow().isoformat()
+    
+    updates = {}
+    for user_id, company_id, *_ in accounts:
+        updates[f'scraper_status/{user_id}/accounts/{company_id}'] = {
+            'status': 'pending',
+            'last_run': now,
+            'error_message': None
+        }
+        updates[f'scraper_status/{user_id}/status'] = 'pending'
+        updates[f'scraper_status/{user_id}/last_run'] = now
+    
+    db.reference().update(updates)
+
+
+def acquire_scrape_job_lock(owner: str, ttl: int) -> bool:
+    """
+    Take the scrape job lease shared by every worker/instance.
+    
+    Args:
+        owner: Unique ID of the job run taking the lease
+        ttl: Seconds after which an unreleased lease may be taken over
+        
+    Returns:
+        True if the lease was acquired, False if another run holds it
+    """
+    now = time.time()
+    
+    def take_lease(current):
+        if current and current.get('expires_at', 0) > now:
+            return current  # Held by another run - leave it unchanged
+        return {'owner': owner, 'expires_at': now + ttl}
+    
+    lease = db.reference('scrape_job_lock').transaction(take_lease)
+    return bool(lease) and lease.get('owner') == owner
+
+
+def release_scrape_job_lock(owner: str):
+    """Release the scrape job lease if it is still held by this run."""
+    def drop_lease(current):
+        if current and current.get('owner') == owner:
+            return None
+        return current
+    
+    db.reference('scrape_job_lock').transaction(drop_lease)
+
+
+def _overall_status(account_statuses: dict, default: str) -> str:
+    """Determine the overall status (error > pending > success) from per-account statuses."""
+    if not account_statuses:
+        return default
+    if any(acc.get('status') == 'error' for acc in account_statuses.values()):
+        return 'error'
+    if any(acc.get('status') == 'pending' for acc in account_statuses.values()):
+        return 'pending'
+    return 'success'
+
+
+def _refresh_overall_status(current_status: dict) -> dict:
+    """Transaction update function: recompute the overall status from the accounts."""
+    if not current_status:
+        return current_status
+    overall_status = _overall_status(current_status.get('accounts', {}), current_status.get('status'))
+    current_status['status'] = overall_status
+    if overall_status != 'error':
+        current_status['error_message'] = None
+    return current_status
+
+
+def _build_scraper_status(current_status: dict, status: str, error_message: str,
+                          company_id: str, now: str) -> dict:
+    """Build the scraper_status/{user_id} object after applying an account status change."""
     # Update account-specific status if company_id provided
     account_statuses = current_status.get('accounts', {})
     if company_id:
         account_statuses[company_id] = {
             'status': status,
-            'last_run': datetime.utcnow().isoformat(),
+            'last_run': now,
             'error_message': error_message
         }
     
-    # Determine overall status (error if any account has error)
-    overall_status = status
-    if account_statuses:
-        has_error = any(acc.get('status') == 'error' for acc in account_statuses.values())
-        has_pending = any(acc.get('status') == 'pending' for acc in account_statuses.values())
-        if has_error:
-            overall_status = 'error'
-        elif has_pending:
-            overall_status = 'pending'
-        else:
-            overall_status = 'success'
+    overall_status = _overall_status(account_statuses, status)
     
-    ref.set({
+    return {
         'status': overall_status,
-        'last_run': datetime.utcnow().isoformat(),
+        'last_run': now,
         'error_message': error_message if overall_status == 'error' else None,
         'has_credentials': True,
         'accounts': account_statuses,
-        'connected_accounts': get_user_connected_accounts(user_id)
-    })
+        # Maintained by _update_connected_accounts - carried over unchanged
+        'connected_accounts': current_status.get('connected_accounts', [])
+    }
+
+
+def update_scraper_status(user_id: str, status: str, error_message: str = None, company_id: str = None):
+    """
+    Update the scraper status for a user.
+    
+    Args:
+        user_id: Firebase user ID
+        status: 'success', 'error', or 'pending'
+        error_message: Optional error message if status is 'error'
+        company_id: Optional company ID for account-specific status
+    """
+    now = datetime.utcnow().isoformat()
+    
+    # Update overall user status in a transaction - the overall status depends on
+    # the other accounts' statuses, so a concurrent write must not be clobbered
+    ref = db.reference(f'scraper_status/{user_id}')
+    ref.transaction(lambda current_status: _build_scraper_status(
+        current_status or {}, status, error_message, company_id, now
+    ))
@@ -0,0 +1,25 @@
+"""
+Gunicorn configuration for production.
+
+Usage:
+    gunicorn -c gunicorn_conf.py app:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# Threaded workers - handlers are I/O bound (Firebase + scraper service).
+# Kept to a small fixed count: every worker has its own scrape thread pools and
+# in-flight scrape de-duplication, and cpu_count() reports the host's CPUs in a container
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+# Scrapes run on background threads, not request threads, so no request waits on the
+# 300s scraper call. gthread workers heartbeat from their main loop - this only
+# restarts a worker whose main loop is stuck
+timeout = 330
+
+# Keep client connections open between requests - longer than a typical
+# load balancer idle timeout (60s) so the proxy closes them first
+keepalive = 65